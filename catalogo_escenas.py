@@ -0,0 +1,265 @@
+import numpy as np
+import os
+import sqlite3
+import hashlib
+import tempfile
+from contextlib import closing
+from datetime import datetime
+from typing import Dict, Any, List, Optional
+from floracion_analyzer import (analizar_floracion_cafe, resumir_floracion, estadisticas_ndvi,
+                                UMBRAL_FLORACION, UMBRAL_FLORACION_INTENSA)
+
+# Carpeta del catálogo local (SQLite + NDVI y máscara de validez en .npy, leídos con mmap)
+CATALOGO_DIR = os.environ.get('FLORABIU_CATALOGO', 'catalogo')
+
+# Histograma NDVI fijo en [-1, 1]; reducir_ndvi lo acumula con bins cerrados a la
+# derecha, (borde_i, borde_i+1], así que contar desde un borde equivale a "NDVI > borde"
+HISTOGRAMA_BINS = 2000
+BORDES_HISTOGRAMA = np.linspace(-1, 1, HISTOGRAMA_BINS + 1)
+
+_ESQUEMA = """
+CREATE TABLE IF NOT EXISTS escenas (
+    id TEXT PRIMARY KEY,
+    fecha_escena TEXT,
+    fecha_procesamiento TEXT NOT NULL,
+    filas INTEGER NOT NULL,
+    columnas INTEGER NOT NULL,
+    pixeles_validos INTEGER NOT NULL,
+    ruta_ndvi TEXT NOT NULL,
+    ruta_mascara TEXT NOT NULL,
+    histograma BLOB NOT NULL,
+    histograma_sumas BLOB NOT NULL,
+    umbral_floracion REAL NOT NULL,
+    umbral_floracion_intensa REAL NOT NULL,
+    area_floracion INTEGER NOT NULL,
+    suma_floracion REAL NOT NULL,
+    area_floracion_intensa INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_escenas_fecha ON escenas (fecha_escena);
+CREATE TABLE IF NOT EXISTS resumenes_tiles (
+    escena_id TEXT NOT NULL REFERENCES escenas (id),
+    fila0 INTEGER NOT NULL,
+    fila1 INTEGER NOT NULL,
+    col0 INTEGER NOT NULL,
+    col1 INTEGER NOT NULL,
+    pixeles_validos INTEGER NOT NULL,
+    suma REAL NOT NULL,
+    suma_cuadrados REAL NOT NULL,
+    minimo REAL NOT NULL,
+    maximo REAL NOT NULL,
+    PRIMARY KEY (escena_id, fila0, col0)
+);
+"""
+
+_COLUMNAS_FLORACION = ('id, fecha_escena, histograma, histograma_sumas, umbral_floracion, '
+                       'umbral_floracion_intensa, area_floracion, suma_floracion, area_floracion_intensa')
+
+# Carpetas de catálogo cuyo esquema ya se creó en este proceso
+_INICIALIZADOS = set()
+
+def _inicializar(catalogo_dir: str) -> None:
+    """Crea la carpeta y el esquema del catálogo una sola vez por proceso"""
+    if catalogo_dir in _INICIALIZADOS:
+        return
+    os.makedirs(catalogo_dir, exist_ok=True)
+    with closing(sqlite3.connect(os.path.join(catalogo_dir, 'catalogo.db'))) as conexion:
+        conexion.executescript(_ESQUEMA)
+    _INICIALIZADOS.add(catalogo_dir)
+
+def _conectar(catalogo_dir: str) -> sqlite3.Connection:
+    """Abre la base SQLite del catálogo"""
+    _inicializar(catalogo_dir)
+    conexion = sqlite3.connect(os.path.join(catalogo_dir, 'catalogo.db'))
+    conexion.row_factory = sqlite3.Row
+    return conexion
+
+def calcular_id_escena(datos: bytes, lut_xml: bytes) -> str:
+    """Identificador estable de la escena: hash de los datos y la LUT usada"""
+    return hashlib.sha256(lut_xml + b'\0' + datos).hexdigest()[:32]
+
+def normalizar_fecha(valor: Any) -> Optional[str]:
+    """Convierte una fecha (texto ISO, datetime64 o array de un elemento) a 'YYYY-MM-DD'"""
+    if valor is None:
+        return None
+    return np.datetime_as_string(np.datetime64(np.asarray(valor).ravel()[0], 'D'), unit='D')
+
+def _bin_umbral(umbral: float) -> int:
+    """Borde del histograma más cercano al umbral; desde ese bin todo es NDVI > borde"""
+    return int(np.abs(BORDES_HISTOGRAMA - umbral).argmin())
+
+def _guardar_array(array: np.ndarray, escena_id: str, nombre: str, catalogo_dir: str) -> str:
+    """Escribe un array en un .npy con nombre único (cada escritor tiene sus propios archivos)"""
+    descriptor, ruta = tempfile.mkstemp(prefix=f'{escena_id}_{nombre}_', suffix='.npy', dir=catalogo_dir)
+    with os.fdopen(descriptor, 'wb') as archivo:
+        np.save(archivo, array)
+    return ruta
+
+def guardar_escena(escena_id: str, ndvi_array: np.ndarray, valid_mask: np.ndarray,
+                   reduccion: Dict[str, Any], fecha_escena: Optional[str] = None,
+                   catalogo_dir: str = CATALOGO_DIR) -> bool:
+    """Guarda una escena procesada en el catálogo
+
+    ``reduccion`` es la de ``reducir_ndvi`` con ``bordes_histograma=BORDES_HISTOGRAMA``:
+    de ella salen el histograma, los resúmenes por tile y los conteos exactos
+    para sus umbrales, sin volver a recorrer los píxeles. ``fecha_escena`` es la
+    fecha de adquisición (None si no se conoce; esas escenas no entran en los
+    filtros por rango de fechas).
+    Devuelve False si la escena ya estaba en el catálogo.
+    """
+    rutas = []
+    insertada = False
+    try:
+        with closing(_conectar(catalogo_dir)) as conexion:
+            if conexion.execute('SELECT 1 FROM escenas WHERE id = ?', (escena_id,)).fetchone():
+                print(f"📚 Escena {escena_id} ya catalogada")
+                return False
+
+            # Los archivos quedan completos antes de que la fila exista
+            rutas.append(_guardar_array(ndvi_array, escena_id, 'ndvi', catalogo_dir))
+            rutas.append(_guardar_array(valid_mask, escena_id, 'mascara', catalogo_dir))
+
+            filas, columnas = ndvi_array.shape[:2]
+            with conexion:
+                insertada = conexion.execute(
+                    'INSERT OR IGNORE INTO escenas VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (escena_id, fecha_escena, datetime.now().isoformat(), filas, columnas,
+                     reduccion['pixeles_validos'], rutas[0], rutas[1],
+                     reduccion['histograma'].tobytes(), reduccion['histograma_sumas'].tobytes(),
+                     reduccion['umbral_floracion'], reduccion['umbral_floracion_intensa'],
+                     reduccion['area_floracion'], reduccion['suma_floracion'],
+                     reduccion['area_floracion_intensa'])).rowcount > 0
+                if insertada:
+                    conexion.executemany(
+                        'INSERT INTO resumenes_tiles VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        [(escena_id, *tile) for tile in reduccion['tiles']])
+
+        if not insertada:
+            # Otro proceso catalogó la misma escena entre la comprobación y el INSERT
+            print(f"📚 Escena {escena_id} ya catalogada")
+            return False
+
+        print(f"📚 Escena {escena_id} catalogada: {len(reduccion['tiles'])} tiles válidos")
+        return True
+
+    except Exception as e:
+        raise Exception(f"Error saving scene to catalog: {str(e)}")
+
+    finally:
+        # Si la fila no quedó registrada, los archivos de este escritor sobran
+        if not insertada:
+            for ruta in rutas:
+                os.remove(ruta)
+
+def eliminar_escena(escena_id: str, catalogo_dir: str = CATALOGO_DIR) -> bool:
+    """Borra una escena del catálogo junto con sus archivos; False si no existía"""
+    with closing(_conectar(catalogo_dir)) as conexion:
+        fila = conexion.execute(
+            'SELECT ruta_ndvi, ruta_mascara FROM escenas WHERE id = ?', (escena_id,)).fetchone()
+        if fila is None:
+            return False
+        with conexion:
+            conexion.execute('DELETE FROM resumenes_tiles WHERE escena_id = ?', (escena_id,))
+            conexion.execute('DELETE FROM escenas WHERE id = ?', (escena_id,))
+
+    for ruta in (fila['ruta_ndvi'], fila['ruta_mascara']):
+        if os.path.exists(ruta):
+            os.remove(ruta)
+    return True
+
+def _consulta_por_fechas(columnas: str, desde: Optional[str], hasta: Optional[str]):
+    """Arma un SELECT sobre escenas filtrado por rango de fechas (ISO)"""
+    consulta = f'SELECT {columnas} FROM escenas'
+    condiciones, parametros = [], []
+    if desde:
+        condiciones.append('fecha_escena >= ?')
+        parametros.append(normalizar_fecha(desde))
+    if hasta:
+        condiciones.append('fecha_escena <= ?')
+        parametros.append(normalizar_fecha(hasta))
+    if condiciones:
+        consulta += ' WHERE ' + ' AND '.join(condiciones)
+    return consulta + ' ORDER BY fecha_escena', parametros
+
+def listar_escenas(desde: Optional[str] = None, hasta: Optional[str] = None,
+                   catalogo_dir: str = CATALOGO_DIR) -> List[Dict[str, Any]]:
+    """Lista los metadatos de las escenas catalogadas, opcionalmente por rango de fechas (ISO)"""
+    consulta, parametros = _consulta_por_fechas(
+        'id, fecha_escena, fecha_procesamiento, filas, columnas, pixeles_validos', desde, hasta)
+    with closing(_conectar(catalogo_dir)) as conexion:
+        return [dict(fila) for fila in conexion.execute(consulta, parametros)]
+
+def _floracion_desde_fila(fila: sqlite3.Row, umbral_floracion: float,
+                          umbral_floracion_intensa: float) -> Dict[str, Any]:
+    """Análisis de floración de una fila de escenas, desde conteos exactos o el histograma"""
+    histograma = np.frombuffer(fila['histograma'], dtype=np.int64)
+
+    if umbral_floracion == fila['umbral_floracion']:
+        area_floracion = fila['area_floracion']
+        suma_floracion = fila['suma_floracion']
+    else:
+        inicio_floracion = _bin_umbral(umbral_floracion)
+        area_floracion = int(histograma[inicio_floracion:].sum())
+        suma_floracion = float(np.frombuffer(fila['histograma_sumas'], dtype=np.float64)[inicio_floracion:].sum())
+
+    if umbral_floracion_intensa == fila['umbral_floracion_intensa']:
+        area_floracion_intensa = fila['area_floracion_intensa']
+    else:
+        area_floracion_intensa = int(histograma[_bin_umbral(umbral_floracion_intensa):].sum())
+
+    intensidad_promedio = suma_floracion / area_floracion if area_floracion > 0 else 0.0
+    return resumir_floracion(int(histograma.sum()), area_floracion, area_floracion_intensa, intensidad_promedio)
+
+def consultar_floracion(escena_id: str, umbral_floracion: float = UMBRAL_FLORACION,
+                        umbral_floracion_intensa: float = UMBRAL_FLORACION_INTENSA,
+                        exacto: bool = False, catalogo_dir: str = CATALOGO_DIR) -> Optional[Dict[str, Any]]:
+    """Análisis de floración de una escena catalogada
+
+    Con los umbrales guardados al catalogar el resultado es exacto y no lee
+    píxeles. Con otros umbrales se resuelve desde el histograma NDVI, tomando el
+    umbral como el borde de bin más cercano (aproximación de ±0.0005), salvo que
+    ``exacto`` sea True: entonces se recorre el NDVI guardado, abierto con mmap,
+    solo en los tiles válidos.
+    Devuelve None si la escena no está catalogada.
+    """
+    with closing(_conectar(catalogo_dir)) as conexion:
+        fila = conexion.execute(
+            f'SELECT {_COLUMNAS_FLORACION}, ruta_ndvi, ruta_mascara FROM escenas WHERE id = ?',
+            (escena_id,)).fetchone()
+    if fila is None:
+        return None
+
+    umbrales_guardados = (umbral_floracion == fila['umbral_floracion']
+                          and umbral_floracion_intensa == fila['umbral_floracion_intensa'])
+    if exacto and not umbrales_guardados:
+        ndvi_array = np.load(fila['ruta_ndvi'], mmap_mode='r')
+        valid_mask = np.load(fila['ruta_mascara'], mmap_mode='r')
+        return analizar_floracion_cafe(ndvi_array, valid_mask, umbral_floracion, umbral_floracion_intensa)
+
+    return _floracion_desde_fila(fila, umbral_floracion, umbral_floracion_intensa)
+
+def consultar_floracion_rango(desde: Optional[str] = None, hasta: Optional[str] = None,
+                              umbral_floracion: float = UMBRAL_FLORACION,
+                              umbral_floracion_intensa: float = UMBRAL_FLORACION_INTENSA,
+                              catalogo_dir: str = CATALOGO_DIR) -> List[Dict[str, Any]]:
+    """Análisis de floración de todas las escenas en un rango de fechas, con una sola consulta"""
+    consulta, parametros = _consulta_por_fechas(_COLUMNAS_FLORACION, desde, hasta)
+    with closing(_conectar(catalogo_dir)) as conexion:
+        filas = conexion.execute(consulta, parametros).fetchall()
+
+    return [{
+        'escena_id': fila['id'],
+        'fecha_escena': fila['fecha_escena'],
+        'analisis_floracion': _floracion_desde_fila(fila, umbral_floracion, umbral_floracion_intensa)
+    } for fila in filas]
+
+def estadisticas_escena(escena_id: str, catalogo_dir: str = CATALOGO_DIR) -> Optional[Dict[str, Any]]:
+    """Estadísticas NDVI de una escena catalogada, combinando los resúmenes por tile"""
+    with closing(_conectar(catalogo_dir)) as conexion:
+        if not conexion.execute('SELECT 1 FROM escenas WHERE id = ?', (escena_id,)).fetchone():
+            return None
+        fila = conexion.execute(
+            'SELECT COALESCE(SUM(pixeles_validos), 0) AS pixeles_validos, SUM(suma) AS suma, '
+            'SUM(suma_cuadrados) AS suma_cuadrados, MIN(minimo) AS minimo, MAX(maximo) AS maximo '
+            'FROM resumenes_tiles WHERE escena_id = ?', (escena_id,)).fetchone()
+
+    return estadisticas_ndvi(dict(fila))
@@ -1,17 +1,27 @@
 import numpy as np
 from datetime import datetime, timedelta
-from typing import Dict, Any
+from typing import Dict, Any, Optional
+from lut_processor import TILE_SIZE, iter_tiles, tile_valid_mask
 
-def analizar_floracion_cafe(ndvi_array: np.ndarray) -> Dict[str, Any]:
-    """Analiza patrones específicos de floración en cultivos de café"""
+# Umbrales para floración en café (ajustables)
+UMBRAL_FLORACION = 0.65
+UMBRAL_FLORACION_INTENSA = 0.75
+
+def analizar_floracion_cafe(ndvi_array: np.ndarray, valid_mask: Optional[np.ndarray] = None,
+                            umbral_floracion: float = UMBRAL_FLORACION,
+                            umbral_floracion_intensa: float = UMBRAL_FLORACION_INTENSA) -> Dict[str, Any]:
+    """Analiza patrones específicos de floración en cultivos de café
+
+    Con ``valid_mask`` el análisis se hace por tiles con ``reducir_ndvi``, solo
+    sobre los píxeles válidos.
+    """
     
-    # Umbrales para floración en café (ajustables)
-    UMBRAL_FLORACION = 0.65
-    UMBRAL_FLORACION_INTENSA = 0.75
+    if valid_mask is not None:
+        return analizar_reduccion(reducir_ndvi(ndvi_array, valid_mask, umbral_floracion, umbral_floracion_intensa))
     
     # Crear máscaras para diferentes intensidades
-    mascara_floracion = ndvi_array > UMBRAL_FLORACION
-    mascara_floracion_intensa = ndvi_array > UMBRAL_FLORACION_INTENSA
+    mascara_floracion = ndvi_array > umbral_floracion
+    mascara_floracion_intensa = ndvi_array > umbral_floracion_intensa
     
     # Calcular áreas
     area_total = ndvi_array.size
@@ -24,23 +34,124 @@ def analizar_floracion_cafe(ndvi_array: np.ndarray) -> Dict[str, Any]:
     else:
         intensidad_promedio = 0.0
     
+    return resumir_floracion(area_total, area_floracion, area_floracion_intensa, intensidad_promedio)
+
+def reducir_ndvi(ndvi_array: np.ndarray, valid_mask: np.ndarray,
+                 umbral_floracion: float = UMBRAL_FLORACION,
+                 umbral_floracion_intensa: float = UMBRAL_FLORACION_INTENSA,
+                 bordes_histograma: Optional[np.ndarray] = None,
+                 tile_size: int = TILE_SIZE) -> Dict[str, Any]:
+    """Reduce el NDVI en una sola pasada por los tiles válidos
+
+    Acumula conteo, suma, suma de cuadrados, mínimo y máximo para las
+    estadísticas (globales y por tile en ``tiles``), y las áreas y suma de
+    floración para el análisis. Con ``bordes_histograma`` acumula además el
+    histograma NDVI con bins cerrados a la derecha y la suma de NDVI por bin.
+    Los tiles totalmente enmascarados no se leen.
+    """
+    reduccion = {
+        'umbral_floracion': umbral_floracion,
+        'umbral_floracion_intensa': umbral_floracion_intensa,
+        'pixeles_validos': 0,
+        'suma': 0.0,
+        'suma_cuadrados': 0.0,
+        'minimo': None,
+        'maximo': None,
+        'area_floracion': 0,
+        'suma_floracion': 0.0,
+        'area_floracion_intensa': 0,
+        'tiles': []
+    }
+    if bordes_histograma is not None:
+        n_bins = len(bordes_histograma) - 1
+        reduccion['histograma'] = np.zeros(n_bins, dtype=np.int64)
+        reduccion['histograma_sumas'] = np.zeros(n_bins, dtype=np.float64)
+    
+    filas, columnas = ndvi_array.shape[:2]
+    for r0, r1, c0, c1 in iter_tiles(filas, columnas, tile_size):
+        valido = tile_valid_mask(valid_mask, r0, r1, c0, c1)
+        if valido is None:
+            continue
+        valores = ndvi_array[r0:r1, c0:c1][valido]
+        floracion = valores[valores > umbral_floracion]
+        minimo, maximo = float(valores.min()), float(valores.max())
+        suma, suma_cuadrados = float(valores.sum()), float(np.dot(valores, valores))
+        
+        reduccion['tiles'].append((r0, r1, c0, c1, int(valores.size), suma, suma_cuadrados, minimo, maximo))
+        reduccion['pixeles_validos'] += int(valores.size)
+        reduccion['suma'] += suma
+        reduccion['suma_cuadrados'] += suma_cuadrados
+        reduccion['minimo'] = minimo if reduccion['minimo'] is None else min(reduccion['minimo'], minimo)
+        reduccion['maximo'] = maximo if reduccion['maximo'] is None else max(reduccion['maximo'], maximo)
+        reduccion['area_floracion'] += int(floracion.size)
+        reduccion['suma_floracion'] += float(floracion.sum())
+        reduccion['area_floracion_intensa'] += int(np.count_nonzero(valores > umbral_floracion_intensa))
+        
+        if bordes_histograma is not None:
+            # Bin (borde_i, borde_i+1]: contar desde un borde equivale a "NDVI > borde"
+            bins = np.clip(np.searchsorted(bordes_histograma, valores, side='left') - 1, 0, n_bins - 1)
+            reduccion['histograma'] += np.bincount(bins, minlength=n_bins)
+            reduccion['histograma_sumas'] += np.bincount(bins, weights=valores, minlength=n_bins)
+    
+    return reduccion
+
+def analizar_reduccion(reduccion: Dict[str, Any]) -> Dict[str, Any]:
+    """Análisis de floración a partir de una reducción de ``reducir_ndvi``"""
+    area_floracion = reduccion['area_floracion']
+    intensidad_promedio = reduccion['suma_floracion'] / area_floracion if area_floracion > 0 else 0.0
+    return resumir_floracion(reduccion['pixeles_validos'], area_floracion,
+                             reduccion['area_floracion_intensa'], intensidad_promedio)
+
+def estadisticas_ndvi(reduccion: Dict[str, Any]) -> Dict[str, Any]:
+    """Estadísticas NDVI (promedio, extremos, desviación) a partir de conteo y sumas"""
+    n = reduccion['pixeles_validos']
+    if n == 0:
+        return {
+            'promedio': None,
+            'maximo': None,
+            'minimo': None,
+            'desviacion_std': None,
+            'pixeles_validos': 0
+        }
+    
+    promedio = reduccion['suma'] / n
+    varianza = max(reduccion['suma_cuadrados'] / n - promedio ** 2, 0.0)
+    return {
+        'promedio': float(promedio),
+        'maximo': float(reduccion['maximo']),
+        'minimo': float(reduccion['minimo']),
+        'desviacion_std': float(np.sqrt(varianza)),
+        'pixeles_validos': int(n)
+    }
+
+def resumir_floracion(area_total: int, area_floracion: int, area_floracion_intensa: int,
+                      intensidad_promedio: float) -> Dict[str, Any]:
+    """Construye el resultado de floración a partir de los conteos de píxeles
+
+    Compartido entre el análisis sobre píxeles y las consultas al catálogo de escenas.
+    """
+    
+    # Evitar división por cero si toda la escena está enmascarada
+    fraccion_floracion = area_floracion / area_total if area_total > 0 else 0.0
+    fraccion_intensa = area_floracion_intensa / area_total if area_total > 0 else 0.0
+    
     # Determinar estado de floración
-    if area_floracion_intensa / area_total > 0.3:
+    if fraccion_intensa > 0.3:
         estado = "floracion_intensa"
-    elif area_floracion / area_total > 0.1:
+    elif fraccion_floracion > 0.1:
         estado = "floracion_detectada"
     else:
         estado = "sin_floracion"
     
     return {
         'estado': estado,
-        'floracion_detectada': area_floracion > 0,
+        'floracion_detectada': bool(area_floracion > 0),
         'intensidad': intensidad_promedio,
         'area_total_pixeles': int(area_total),
         'area_floracion_pixeles': int(area_floracion),
         'area_floracion_intensa_pixeles': int(area_floracion_intensa),
-        'porcentaje_area': float(area_floracion / area_total * 100),
-        'porcentaje_area_intensa': float(area_floracion_intensa / area_total * 100),
+        'porcentaje_area': float(fraccion_floracion * 100),
+        'porcentaje_area_intensa': float(fraccion_intensa * 100),
         'confianza_deteccion': min(0.95, intensidad_promedio)  # Confianza basada en intensidad
     }
 
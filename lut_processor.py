@@ -1,6 +1,19 @@
 import numpy as np
 import xml.etree.ElementTree as ET
-from typing import Dict, Any
+from typing import Dict, Any, Iterator, Optional, Sequence, Tuple
+
+# Tamaño de tile (en píxeles) para recorrer la imagen; múltiplo de 8 para que
+# cada tile empiece en un byte de la máscara empaquetada
+TILE_SIZE = 256
+
+# Valores DN que el sensor usa como "sin dato"
+NODATA_VALUES = (0,)
+
+# Valores DN saturados adicionales a los extremos de la LUT (ninguno por defecto)
+SATURATION_VALUES = ()
+
+# Número de bits a 1 en cada byte, para contar píxeles válidos sin desempaquetar
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
 
 def parse_lut_xml(lut_xml: bytes) -> Dict[str, Any]:
     """Parsea archivo LUT XML y extrae parámetros de calibración"""
@@ -21,19 +34,99 @@ def parse_lut_xml(lut_xml: bytes) -> Dict[str, Any]:
     except Exception as e:
         raise Exception(f"Error parsing LUT XML: {str(e)}")
 
-def apply_lut_to_array(image_array: np.ndarray, lut_table: Dict[str, Any]) -> np.ndarray:
-    """Aplica calibración LUT a un array de imagen"""
+def iter_tiles(rows: int, cols: int, tile_size: int) -> Iterator[Tuple[int, int, int, int]]:
+    """Recorre la imagen por tiles, devolviendo (fila0, fila1, col0, col1)"""
+    for r0 in range(0, rows, tile_size):
+        r1 = min(r0 + tile_size, rows)
+        for c0 in range(0, cols, tile_size):
+            yield r0, r1, c0, min(c0 + tile_size, cols)
+
+def tile_valid_mask(valid_mask: np.ndarray, r0: int, r1: int, c0: int, c1: int) -> Optional[np.ndarray]:
+    """Desempaqueta solo el trozo de máscara de un tile; None si el tile está totalmente enmascarado"""
+    b0, b1 = c0 // 8, (c1 + 7) // 8
+    bytes_tile = valid_mask[r0:r1, b0:b1]
+    if not bytes_tile.any():
+        return None
+    valido = np.unpackbits(bytes_tile, axis=1)[:, c0 - b0 * 8:c1 - b0 * 8].astype(bool)
+    return valido if valido.any() else None
+
+def compute_validity_mask(image_array: np.ndarray, lut_table: Dict[str, Any],
+                          cloud_mask: Optional[np.ndarray] = None,
+                          nodata_values: Sequence[int] = NODATA_VALUES,
+                          saturation_values: Sequence[int] = SATURATION_VALUES,
+                          tile_size: int = TILE_SIZE) -> np.ndarray:
+    """Calcula la máscara de píxeles válidos, empaquetada en bits por fila (1 = válido)
+
+    Un píxel es inválido si alguna banda tiene un DN de no-data, si algún DN está
+    en los extremos de la LUT o fuera de ellos, o es un valor de saturación
+    conocido, o si está marcado en la capa de nubes.
+    """
+    try:
+        if lut_table['step_size'] != -1:
+            raise ValueError(f"step_size {lut_table['step_size']} no soportado (solo -1)")
+        
+        p0 = lut_table['pixel_first_value']
+        dn_min = p0 - (len(lut_table['gains']) - 1)
+        rows, cols = image_array.shape[:2]
+        valid_mask = np.empty((rows, (cols + 7) // 8), dtype=np.uint8)
+        
+        # Procesar por bloques de filas para no crear temporales del tamaño de la imagen
+        for r0 in range(0, rows, tile_size):
+            r1 = min(r0 + tile_size, rows)
+            bloque = image_array[r0:r1].astype(np.int64)
+            valido = (bloque > dn_min) & (bloque < p0)
+            for invalido in (*nodata_values, *saturation_values):
+                valido &= bloque != invalido
+            if valido.ndim == 3:
+                valido = valido.all(axis=2)
+            if cloud_mask is not None:
+                valido &= ~cloud_mask[r0:r1].astype(bool)
+            valid_mask[r0:r1] = np.packbits(valido, axis=1)
+        
+        print(f"🛡️ Máscara de validez: {count_valid_pixels(valid_mask)}/{rows * cols} píxeles válidos")
+        return valid_mask
+        
+    except Exception as e:
+        raise Exception(f"Error computing validity mask: {str(e)}")
+
+def count_valid_pixels(valid_mask: np.ndarray) -> int:
+    """Cuenta los píxeles válidos de una máscara empaquetada"""
+    return int(_POPCOUNT[valid_mask].sum(dtype=np.int64))
+
+def apply_lut_to_array(image_array: np.ndarray, lut_table: Dict[str, Any],
+                       valid_mask: Optional[np.ndarray] = None,
+                       tile_size: int = TILE_SIZE) -> np.ndarray:
+    """Aplica calibración LUT a un array de imagen
+
+    Si se pasa ``valid_mask`` los tiles totalmente enmascarados no se calibran
+    y los píxeles inválidos quedan como NaN.
+    """
     try:
         p0 = lut_table['pixel_first_value']
         step = lut_table['step_size']
         gains = lut_table['gains']
         
-        # Para step_size = -1 (como en tu ejemplo)
-        indices = p0 - image_array
-        indices = np.clip(indices, 0, len(gains) - 1)
-        
-        # Aplicar ganancias
-        calibrated_array = image_array * gains[indices.astype(int)]
+        if valid_mask is None:
+            # Para step_size = -1 (como en tu ejemplo)
+            indices = p0 - image_array
+            indices = np.clip(indices, 0, len(gains) - 1)
+            
+            # Aplicar ganancias
+            calibrated_array = image_array * gains[indices.astype(int)]
+        else:
+            # Sin inicializar: solo se rellenan con NaN los tiles enmascarados
+            calibrated_array = np.empty(image_array.shape, dtype=gains.dtype)
+            rows, cols = image_array.shape[:2]
+            for r0, r1, c0, c1 in iter_tiles(rows, cols, tile_size):
+                valido = tile_valid_mask(valid_mask, r0, r1, c0, c1)
+                if valido is None:
+                    calibrated_array[r0:r1, c0:c1] = np.nan
+                    continue
+                bloque = image_array[r0:r1, c0:c1]
+                indices = np.clip(p0 - bloque.astype(np.int64), 0, len(gains) - 1)
+                tile = bloque * gains[indices]
+                tile[~valido] = np.nan
+                calibrated_array[r0:r1, c0:c1] = tile
         
         print(f"🎯 LUT aplicada: {image_array.shape} → {calibrated_array.shape}")
         return calibrated_array
@@ -41,30 +134,59 @@ def apply_lut_to_array(image_array: np.ndarray, lut_table: Dict[str, Any]) -> np
     except Exception as e:
         raise Exception(f"Error applying LUT: {str(e)}")
 
-def compute_indices(calibrated_array: np.ndarray) -> Dict[str, np.ndarray]:
-    """Calcula índices de vegetación a partir de array calibrado"""
+def _ndvi(calibrated_array: np.ndarray) -> np.ndarray:
+    """Calcula NDVI de un array (o tile) calibrado"""
+    # Asumiendo que calibrated_array tiene bandas [azul, verde, rojo, infrarrojo]
+    # Ajustar índices según tu estructura de bandas
+    red_band = calibrated_array[:, :, 2]   # Banda roja
+    nir_band = calibrated_array[:, :, 3]   # Banda infrarrojo
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ndvi = (nir_band - red_band) / (nir_band + red_band)
+        return np.nan_to_num(ndvi, nan=-1, posinf=1, neginf=-1)
+
+def _evi(calibrated_array: np.ndarray) -> np.ndarray:
+    """Calcula EVI de un array (o tile) calibrado"""
+    blue_band = calibrated_array[:, :, 0]  # Banda azul
+    red_band = calibrated_array[:, :, 2]   # Banda roja
+    nir_band = calibrated_array[:, :, 3]   # Banda infrarrojo
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        evi = 2.5 * (nir_band - red_band) / (nir_band + 6 * red_band - 7.5 * blue_band + 1)
+        return np.nan_to_num(evi, nan=-1, posinf=1, neginf=-1)
+
+def compute_indices(calibrated_array: np.ndarray, valid_mask: Optional[np.ndarray] = None,
+                    include_evi: bool = True, tile_size: int = TILE_SIZE) -> Dict[str, np.ndarray]:
+    """Calcula índices de vegetación a partir de array calibrado
+
+    Con ``valid_mask`` los píxeles inválidos quedan como NaN (en lugar de −1/1)
+    para que las estadísticas posteriores los excluyan. Con ``include_evi=False``
+    no se calcula ni se reserva memoria para EVI.
+    """
     try:
-        # Asumiendo que calibrated_array tiene bandas [rojo, infrarrojo, ...]
-        # Ajustar índices según tu estructura de bandas
-        red_band = calibrated_array[:, :, 2]   # Banda roja
-        nir_band = calibrated_array[:, :, 3]   # Banda infrarrojo
+        nombres = ['NDVI', 'EVI'] if include_evi else ['NDVI']
+        funciones = {'NDVI': _ndvi, 'EVI': _evi}
         
-        # Calcular NDVI
-        with np.errstate(divide='ignore', invalid='ignore'):
-            ndvi = (nir_band - red_band) / (nir_band + red_band)
-            ndvi = np.nan_to_num(ndvi, nan=-1, posinf=1, neginf=-1)
+        if valid_mask is None:
+            indices = {nombre: funciones[nombre](calibrated_array) for nombre in nombres}
+            ndvi = indices['NDVI']
+            print(f"📊 Índices calculados: NDVI range [{ndvi.min():.3f}, {ndvi.max():.3f}]")
+            return indices
         
-        # Calcular EVI (opcional)
-        blue_band = calibrated_array[:, :, 0]  # Banda azul
-        evi = 2.5 * (nir_band - red_band) / (nir_band + 6 * red_band - 7.5 * blue_band + 1)
-        evi = np.nan_to_num(evi, nan=-1, posinf=1, neginf=-1)
-        
-        indices = {
-            'NDVI': ndvi,
-            'EVI': evi
-        }
+        # Sin inicializar: solo se rellenan con NaN los tiles enmascarados
+        rows, cols = calibrated_array.shape[:2]
+        indices = {nombre: np.empty((rows, cols)) for nombre in nombres}
+        for r0, r1, c0, c1 in iter_tiles(rows, cols, tile_size):
+            valido = tile_valid_mask(valid_mask, r0, r1, c0, c1)
+            for nombre in nombres:
+                if valido is None:
+                    indices[nombre][r0:r1, c0:c1] = np.nan
+                    continue
+                tile = funciones[nombre](calibrated_array[r0:r1, c0:c1])
+                tile[~valido] = np.nan
+                indices[nombre][r0:r1, c0:c1] = tile
         
-        print(f"📊 Índices calculados: NDVI range [{ndvi.min():.3f}, {ndvi.max():.3f}]")
+        print(f"📊 Índices calculados: {', '.join(nombres)} {(rows, cols)}, {count_valid_pixels(valid_mask)} píxeles válidos")
         return indices
         
     except Exception as e:
@@ -1,11 +1,15 @@
-from fastapi import FastAPI, UploadFile, File
+from fastapi import FastAPI, UploadFile, File, Form
 from fastapi.responses import JSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 import numpy as np
 import uvicorn
-from lut_processor import parse_lut_xml, apply_lut_to_array, compute_indices
-from floracion_analyzer import analizar_floracion_cafe, generar_recomendaciones, detectar_patrones_temporales
+from lut_processor import parse_lut_xml, apply_lut_to_array, compute_indices, compute_validity_mask
+from floracion_analyzer import reducir_ndvi, analizar_reduccion, estadisticas_ndvi, generar_recomendaciones, detectar_patrones_temporales
+from floracion_analyzer import UMBRAL_FLORACION, UMBRAL_FLORACION_INTENSA
+from catalogo_escenas import calcular_id_escena, normalizar_fecha, guardar_escena, eliminar_escena, listar_escenas, consultar_floracion, consultar_floracion_rango, estadisticas_escena
+from catalogo_escenas import BORDES_HISTOGRAMA
+from typing import Optional
 import os
 from datetime import datetime
 import json
@@ -21,7 +25,13 @@ app.add_middleware(
 )
 
 @app.post('/process')
-async def process(lut: UploadFile = File(...), data: UploadFile = File(...)):
+async def process(lut: UploadFile = File(...), data: UploadFile = File(...), fecha: Optional[str] = Form(None)):
+    # La fecha de adquisición (YYYY-MM-DD) se valida antes de procesar
+    try:
+        fecha_escena = normalizar_fecha(fecha) if fecha else None
+    except ValueError as e:
+        return JSONResponse({'error': f'Fecha inválida: {str(e)}'}, status_code=400)
+    
     try:
         print("🌺 Procesando datos de floración...")
         
@@ -38,43 +48,58 @@ async def process(lut: UploadFile = File(...), data: UploadFile = File(...)):
         arr = npz['arr']
         print(f"📊 Datos cargados: {arr.shape}")
         
-        # 3. APLICAR CALIBRACIÓN LUT
-        calibrated = apply_lut_to_array(arr, lut_table)
+        # 3. MÁSCARA DE VALIDEZ (no-data, saturación y nubes si vienen en el .npz)
+        nubes = npz['nubes'] if 'nubes' in npz else None
+        mascara_validez = compute_validity_mask(arr, lut_table, cloud_mask=nubes)
+        
+        # 4. APLICAR CALIBRACIÓN LUT
+        calibrated = apply_lut_to_array(arr, lut_table, mascara_validez)
         print("🎯 Calibración LUT aplicada")
         
-        # 4. CALCULAR ÍNDICES DE VEGETACIÓN
-        indices = compute_indices(calibrated)
+        # 5. CALCULAR ÍNDICES DE VEGETACIÓN
+        indices = compute_indices(calibrated, mascara_validez, include_evi=False)
         ndvi_array = indices['NDVI']
         print(f"📈 NDVI calculado: {ndvi_array.shape}")
         
-        # 5. ANALIZAR FLORACIÓN ESPECÍFICA
-        analisis_floracion = analizar_floracion_cafe(ndvi_array)
+        # 6. ANALIZAR FLORACIÓN ESPECÍFICA (una sola pasada por tiles para análisis,
+        # estadísticas y el histograma del catálogo)
+        reduccion_ndvi = reducir_ndvi(ndvi_array, mascara_validez, bordes_histograma=BORDES_HISTOGRAMA)
+        analisis_floracion = analizar_reduccion(reduccion_ndvi)
         
-        # 6. GENERAR RECOMENDACIONES
+        # 7. GENERAR RECOMENDACIONES
         recomendaciones = generar_recomendaciones(analisis_floracion)
         
-        # 7. DETECTAR PATRONES TEMPORALES (si hay datos históricos)
+        # 8. DETECTAR PATRONES TEMPORALES (si hay datos históricos)
         if 'fechas' in npz:
             patrones = detectar_patrones_temporales(ndvi_array, npz['fechas'])
         else:
             patrones = {"mensaje": "No hay datos temporales para análisis histórico"}
         
-        # 8. PREPARAR RESPUESTA COMPLETA
+        # 9. GUARDAR EN EL CATÁLOGO PARA CONSULTAS POSTERIORES
+        # La fecha de adquisición viene del campo 'fecha' del formulario o de la
+        # clave 'fecha' del .npz; sin ella la escena no entra en filtros por fecha.
+        # Un fallo del catálogo no invalida el análisis ya hecho.
+        try:
+            escena_id = calcular_id_escena(content, lut_xml)
+            if fecha_escena is None and 'fecha' in npz:
+                fecha_escena = normalizar_fecha(npz['fecha'])
+            guardar_escena(escena_id, ndvi_array, mascara_validez, reduccion_ndvi, fecha_escena)
+        except Exception as e:
+            print(f"⚠️ No se pudo catalogar la escena: {str(e)}")
+            escena_id = None
+        
+        # 10. PREPARAR RESPUESTA COMPLETA
         resp = {
             'proyecto': 'FLORABIU - Monitoreo de Floración en Café',
+            'escena_id': escena_id,
             'fecha_procesamiento': datetime.now().isoformat(),
             'metadatos_imagen': {
                 'dimensiones': calibrated.shape,
                 'tipo_lut': 'LUTSIGMA',
-                'pixeles_totales': calibrated.shape[0] * calibrated.shape[1]
-            },
-            'estadisticas_ndvi': {
-                'promedio': float(np.nanmean(ndvi_array)),
-                'maximo': float(np.nanmax(ndvi_array)),
-                'minimo': float(np.nanmin(ndvi_array)),
-                'desviacion_std': float(np.nanstd(ndvi_array)),
-                'pixeles_validos': int(np.sum(~np.isnan(ndvi_array)))
+                'pixeles_totales': calibrated.shape[0] * calibrated.shape[1],
+                'pixeles_enmascarados': calibrated.shape[0] * calibrated.shape[1] - reduccion_ndvi['pixeles_validos']
             },
+            'estadisticas_ndvi': estadisticas_ndvi(reduccion_ndvi),
             'analisis_floracion': analisis_floracion,
             'recomendaciones': recomendaciones,
             'patrones_temporales': patrones,
@@ -119,6 +144,57 @@ def generar_alertas(analisis):
     
     return alertas
 
+@app.get('/escenas')
+async def escenas(desde: Optional[str] = None, hasta: Optional[str] = None):
+    """Lista las escenas catalogadas, opcionalmente entre dos fechas (YYYY-MM-DD)"""
+    try:
+        return JSONResponse({'escenas': listar_escenas(desde, hasta)})
+    except ValueError as e:
+        return JSONResponse({'error': f'Fecha inválida: {str(e)}'}, status_code=400)
+
+@app.get('/escenas/{escena_id}/estadisticas')
+async def escena_estadisticas(escena_id: str):
+    """Estadísticas NDVI de una escena catalogada, sin re-procesar los píxeles"""
+    estadisticas = estadisticas_escena(escena_id)
+    if estadisticas is None:
+        return JSONResponse({'error': f'Escena no catalogada: {escena_id}'}, status_code=404)
+    return JSONResponse({'escena_id': escena_id, 'estadisticas_ndvi': estadisticas})
+
+@app.get('/escenas/{escena_id}/floracion')
+async def escena_floracion(escena_id: str, umbral: float = UMBRAL_FLORACION,
+                           umbral_intenso: float = UMBRAL_FLORACION_INTENSA, exacto: bool = False):
+    """Re-analiza la floración de una escena catalogada con otros umbrales
+
+    Por defecto se responde desde el histograma; con ``exacto=true`` se cuentan
+    los píxeles del NDVI guardado.
+    """
+    analisis_floracion = consultar_floracion(escena_id, umbral, umbral_intenso, exacto)
+    if analisis_floracion is None:
+        return JSONResponse({'error': f'Escena no catalogada: {escena_id}'}, status_code=404)
+    return JSONResponse({
+        'escena_id': escena_id,
+        'analisis_floracion': analisis_floracion,
+        'recomendaciones': generar_recomendaciones(analisis_floracion),
+        'alertas': generar_alertas(analisis_floracion)
+    })
+
+@app.delete('/escenas/{escena_id}')
+async def escena_eliminar(escena_id: str):
+    """Elimina una escena del catálogo y sus archivos"""
+    if not eliminar_escena(escena_id):
+        return JSONResponse({'error': f'Escena no catalogada: {escena_id}'}, status_code=404)
+    return JSONResponse({'escena_id': escena_id, 'eliminada': True})
+
+@app.get('/floracion')
+async def floracion(desde: Optional[str] = None, hasta: Optional[str] = None,
+                    umbral: float = UMBRAL_FLORACION, umbral_intenso: float = UMBRAL_FLORACION_INTENSA):
+    """Análisis de floración de todas las escenas catalogadas en un rango de fechas"""
+    try:
+        resultados = consultar_floracion_rango(desde, hasta, umbral, umbral_intenso)
+    except ValueError as e:
+        return JSONResponse({'error': f'Fecha inválida: {str(e)}'}, status_code=400)
+    return JSONResponse({'umbral': umbral, 'umbral_intenso': umbral_intenso, 'escenas': resultados})
+
 @app.get('/')
 async def root():
     return {"message": "FLORABIU API - Sistema de monitoreo de floración"}